@@ -2,6 +2,12 @@ import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
 import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.dataset as ds
+from pyarrow import csv as pa_csv
 
 # ----------------------------------------
 # User Input for battery_id
@@ -11,28 +17,36 @@ battery_input = input("Enter battery IDs separated by commas (e.g., B0047,B0050)
 # ----------------------------------------
 # Step 1: Load and Parse metadata.csv
 # ----------------------------------------
-metadata = pd.read_csv('cleaned_dataset/metadata.csv')
-
-def parse_matlab_time(str_time):
-    str_time = str_time.strip().strip('[]')
-    parts = str_time.split()
-    # If not exactly 6 parts, return NaT
-    if len(parts) != 6:
-        return pd.NaT
-    arr = [float(x) for x in parts]
-    year, month, day, hour, minute, sec = arr
-    sec_int = int(sec)
-    microseconds = int(round((sec - sec_int) * 1_000_000))
-    return pd.Timestamp(year=int(year), month=int(month), day=int(day),
-                        hour=int(hour), minute=int(minute), second=sec_int, microsecond=microseconds)
-
-metadata['start_time'] = metadata['start_time'].apply(parse_matlab_time)
+# pyarrow parses the file multithreaded; giving the dtypes up front skips type inference.
+# Re, Rct and Capacity contain some non-numeric entries, so they're read as strings and converted below
+metadata = pd.read_csv('cleaned_dataset/metadata.csv', engine='pyarrow',
+                       dtype={'battery_id': 'string', 'type': 'string', 'filename': 'string',
+                              'start_time': 'string', 'Re': 'string', 'Rct': 'string', 'Capacity': 'string'})
+# Few distinct values, so store them as categories: the type/battery_id filters below then compare integer codes
+metadata['type'] = metadata['type'].astype('category')
+metadata['battery_id'] = metadata['battery_id'].astype('category')
+
+def parse_matlab_time(time_col):
+    # Strings look like "[2010.  7.  21.  15.  0.  35.093]": split the whole column at once
+    parts = time_col.str.strip().str.strip('[]').str.split(expand=True)
+    # If not exactly 6 parts, the row becomes NaT
+    n_parts = parts.notna().sum(axis=1).to_numpy()
+    fields = parts.reindex(columns=range(6)).to_numpy(dtype=np.float64, na_value=np.nan)
+    fields[n_parts != 6] = np.nan
+    year, month, day, hour, minute, sec = fields.T
+    sec_int = np.floor(sec)
+    microseconds = np.round((sec - sec_int) * 1_000_000)
+    return pd.to_datetime(pd.DataFrame(dict(year=year, month=month, day=day, hour=hour, minute=minute,
+                                            second=sec_int, us=microseconds), index=time_col.index),
+                          errors='coerce')
+
+metadata['start_time'] = parse_matlab_time(metadata['start_time'])
 metadata = metadata.sort_values('start_time').reset_index(drop=True)
 
 # Convert numerical columns
-metadata['Re'] = pd.to_numeric(metadata['Re'], errors='coerce')
-metadata['Rct'] = pd.to_numeric(metadata['Rct'], errors='coerce')
-metadata['Capacity'] = pd.to_numeric(metadata['Capacity'], errors='coerce')
+# float32 is plenty for these measurements and halves the memory of every later filter and plot
+for col in ['Re', 'Rct', 'Capacity']:
+    metadata[col] = pd.to_numeric(metadata[col], errors='coerce').to_numpy(dtype=np.float32, na_value=np.nan)
 
 # ----------------------------------------
 # Filter by user-selected battery_ids
@@ -40,7 +54,7 @@ metadata['Capacity'] = pd.to_numeric(metadata['Capacity'], errors='coerce')
 if battery_input:
     # Split the input string into a list of battery IDs
     selected_batteries = [b_id.strip() for b_id in battery_input.split(',')]
-    metadata = metadata[metadata['battery_id'].isin(selected_batteries)].copy()
+    metadata = metadata[metadata['battery_id'].isin(selected_batteries)]
 else:
     selected_batteries = metadata['battery_id'].unique()
     battery_input = 'all Batteries'
@@ -53,81 +67,179 @@ if len(metadata) == 0:
 # ----------------------------------------
 # Separate operations by type
 # ----------------------------------------
-impedance_data = metadata[metadata['type'] == 'impedance'].copy()
-discharge_data = metadata[metadata['type'] == 'discharge'].copy()
+impedance_data = metadata[metadata['type'] == 'impedance']
+discharge_data = metadata[metadata['type'] == 'discharge']
 
 # Assign cycle numbers per battery
+def cycle_numbers(battery_codes):
+    # Rows are sorted by battery, so each battery is one contiguous block:
+    # count up from 1 and restart at the first row of every block
+    is_start = np.ones(len(battery_codes), dtype=bool)
+    is_start[1:] = battery_codes[1:] != battery_codes[:-1]
+    starts = np.flatnonzero(is_start)
+    block_start = np.repeat(starts, np.diff(np.append(starts, len(battery_codes))))
+    return np.arange(len(battery_codes)) - block_start + 1
+
 # For discharge operations
 discharge_data = discharge_data.sort_values(['battery_id', 'start_time']).reset_index(drop=True)
-discharge_data['cycle_number'] = discharge_data.groupby('battery_id').cumcount() + 1
+discharge_data['cycle_number'] = cycle_numbers(discharge_data['battery_id'].cat.codes.to_numpy())
 
 # For impedance operations
 impedance_data = impedance_data.sort_values(['battery_id', 'start_time']).reset_index(drop=True)
-impedance_data['impedance_cycle_number'] = impedance_data.groupby('battery_id').cumcount() + 1
+impedance_data['impedance_cycle_number'] = cycle_numbers(impedance_data['battery_id'].cat.codes.to_numpy())
 
 # ----------------------------------------
 # Function to safely parse Rectified_Impedance
 # ----------------------------------------
-def to_complex_or_float(x):
-    if pd.isnull(x):
-        return np.nan
-    if isinstance(x, (float, int)):
-        # Already a number, just convert to complex (real only)
-        return complex(x)
-    if isinstance(x, str):
-        x = x.strip().strip('()')
-        if not x:
-            return np.nan
-        try:
-            return complex(x)
-        except ValueError:
-            # If it's not a valid complex string, just return NaN
-            return np.nan
-    return np.nan
+# Matches complex() strings such as "0.05+0.01j", "1e-3-2j", "4j" or "1+infj".
+# The real part only matches when followed by the sign of the imaginary part (or the end)
+NUMBER_PATTERN = r'(?:(?:\d+\.?\d*|\.\d+)(?:e[-+]?\d+)?|inf(?:inity)?|nan)'
+COMPLEX_RE = re.compile(rf'^\s*(?:(?P<real>[-+]?{NUMBER_PATTERN})(?=[-+]|\s*$))?'
+                        rf'(?:(?P<imag>[-+]?{NUMBER_PATTERN}?)j)?\s*$', re.IGNORECASE)
+
+def to_complex_or_float(col):
+    if pd.api.types.is_numeric_dtype(col):
+        # Already numbers (real only)
+        return col.astype(float)
+    values = col.astype(str).str.strip().str.strip('()')
+    # Plain floats are converted in one go; only complex strings like "0.05+0.01j" are left as NaN
+    real_values = pd.to_numeric(values, errors='coerce')
+    is_complex = real_values.isna() & col.notna() & (values != '')
+    if is_complex.any():
+        # The same values repeat a lot within a file, so only parse each distinct string once
+        codes, unique_strings = pd.factorize(values[is_complex])
+        # Pull the real part straight out of the string instead of building complex objects.
+        # Strings that don't match stay NaN, purely imaginary ones have a real part of 0
+        parts = pd.Series(unique_strings, dtype=object).str.extract(COMPLEX_RE)
+        unique_real = parts['real'].astype(float)
+        unique_real[parts['real'].isna() & parts['imag'].notna()] = 0.0
+        real_values[is_complex] = unique_real.to_numpy()[codes]
+    return real_values
 
 # ----------------------------------------
 # Extract Rectified_Impedance from data files
 # ----------------------------------------
-def get_rectified_impedance(file_path):
-    if not os.path.exists(file_path):
-        # File doesn't exist
-        return np.nan
+def scan_rectified_impedance(file_paths):
+    # One multithreaded Arrow scan over all the files, reading only the Rectified_Impedance
+    # column as strings (null in files that don't have it)
+    csv_format = ds.CsvFileFormat(
+        convert_options=pa_csv.ConvertOptions(column_types={'Rectified_Impedance': pa.string()}))
+    dataset = ds.dataset(file_paths, format=csv_format,
+                         schema=pa.schema([('Rectified_Impedance', pa.string())]))
+    batch_filenames, batches = [], []
+    # Each batch is tagged with the file it was read from
+    for tagged in dataset.scanner(columns=['Rectified_Impedance']).scan_batches():
+        batch_filenames.append(os.path.basename(tagged.fragment.path))
+        batches.append(tagged.record_batch.column(0).to_pandas())
+    if not batches:
+        return pd.Series(dtype=float)
+    # Take the real part if complex, or value if float, for all files in one pass
+    return to_complex_or_float(pd.concat(batches, keys=batch_filenames))
+
+def read_rectified_impedance(file_path):
     try:
-        df = pd.read_csv(file_path)
+        # Only the one column is needed, so skip parsing the others
+        # (a callable usecols leaves the frame empty instead of raising when the column is missing)
+        df = pd.read_csv(file_path, usecols=lambda c: c == 'Rectified_Impedance',
+                         engine='c', low_memory=False)
         if 'Rectified_Impedance' in df.columns:
-            df['Rectified_Impedance'] = df['Rectified_Impedance'].apply(to_complex_or_float)
             # Take the real part if complex, or value if float
-            real_values = df['Rectified_Impedance'].apply(lambda c: c.real if isinstance(c, complex) else c)
-            # Example: take median to represent the measurement
-            return real_values.median()
+            return to_complex_or_float(df['Rectified_Impedance'])
         else:
-            # Column not found, return NaN
-            return np.nan
+            # Column not found, no values
+            return pd.Series(dtype=float)
     except Exception as e:
+        # None (rather than no values) so the failure isn't cached and the file is retried next run
         print(f"Error reading {file_path}: {e}")
-        return np.nan
+        return None
 
 data_base_path = 'cleaned_dataset/data/'
-rectified_values = []
-for idx, row in impedance_data.iterrows():
-    fname = row['filename']
-    file_path = os.path.join(data_base_path, fname)
-    rect_val = get_rectified_impedance(file_path)
-    rectified_values.append(rect_val)
+filenames = impedance_data['filename'].to_numpy()
+paths = [os.path.join(data_base_path, fname) for fname in filenames]
+
+# Medians from earlier runs, keyed by filename; a file is only parsed again if its mtime or size changed
+cache_path = 'rect_impedance_cache.parquet'
+# Bump whenever the way medians are computed changes, so entries from older code are parsed again
+cache_version = 1
+cache_columns = ['mtime', 'size', 'median', 'version']
+cache = pd.DataFrame({col: pd.Series(dtype=float) for col in cache_columns},
+                     index=pd.Index([], name='filename'))
+if os.path.exists(cache_path):
+    try:
+        # Caches written before a column existed get NaNs there, so those files are parsed again
+        stored = pd.read_parquet(cache_path).reindex(columns=cache_columns)
+        cache = stored[stored['version'] == cache_version]
+    except (OSError, pa.ArrowException) as e:
+        # A damaged cache just means parsing everything again; it's rewritten below
+        print(f"Ignoring unreadable cache {cache_path}: {e}")
+
+# List the data folder once instead of checking every file for existence
+existing_files = {entry.name for entry in os.scandir(data_base_path) if entry.is_file()}
+# Missing files get a NaN mtime and size, and NaN Rectified_Impedance
+stats = [os.stat(file_path) if fname in existing_files else None
+         for fname, file_path in zip(filenames, paths)]
+mtimes = np.array([st.st_mtime if st else np.nan for st in stats], dtype=float)
+sizes = np.array([st.st_size if st else np.nan for st in stats], dtype=float)
+file_exists = ~np.isnan(mtimes)
+cached = cache.reindex(filenames)
+rectified_values = cached['median'].to_numpy(dtype=float, copy=True)
+rectified_values[~file_exists] = np.nan
+needs_parsing = ((cached['mtime'].to_numpy(dtype=float) != mtimes) |
+                 (cached['size'].to_numpy(dtype=float) != sizes)) & file_exists
+paths_to_parse = [file_path for file_path, parse in zip(paths, needs_parsing) if parse]
+
+# Files that couldn't be read; their NaN isn't cached
+read_failed = np.zeros(len(filenames), dtype=bool)
 
-impedance_data['Rectified_Impedance'] = rectified_values
+# Values of every parsed file, keyed by filename; the median of each file (to represent the
+# measurement) then comes from a single groupby, and files without values stay NaN
+if paths_to_parse:
+    try:
+        parsed_values = scan_rectified_impedance(paths_to_parse)
+    except (pa.ArrowException, OSError):
+        # One unreadable file fails the whole scan, so fall back to reading the files one by one,
+        # which reports and skips the bad ones. They're independent, so spread them over a pool
+        # (threads rather than processes: the script runs top-level input(), which
+        # spawned worker processes would re-execute on import)
+        with ThreadPoolExecutor() as executor:
+            per_file_values = list(executor.map(read_rectified_impedance, paths_to_parse))
+        read_failed[needs_parsing] = [values is None for values in per_file_values]
+        parsed_values = pd.concat([pd.Series(dtype=float) if values is None else values
+                                   for values in per_file_values],
+                                  keys=filenames[needs_parsing])
+    medians = parsed_values.groupby(level=0).median()
+    rectified_values[needs_parsing] = medians.reindex(filenames[needs_parsing]).to_numpy(dtype=float)
+
+# Save the new medians of the files that were actually read (a missing column counts, an error doesn't)
+to_cache = needs_parsing & ~read_failed
+new_entries = pd.DataFrame({'mtime': mtimes[to_cache], 'size': sizes[to_cache],
+                            'median': rectified_values[to_cache], 'version': cache_version},
+                           index=pd.Index(filenames[to_cache], name='filename'))
+if len(new_entries):
+    new_entries = new_entries[~new_entries.index.duplicated(keep='last')]
+    cache = pd.concat([cache.drop(new_entries.index, errors='ignore'), new_entries])
+    # Write to a temp file next to the cache and swap it in, so an interrupted write
+    # never leaves a truncated cache behind
+    fd, tmp_path = tempfile.mkstemp(prefix='rect_impedance_cache.', suffix='.tmp',
+                                    dir=os.path.dirname(os.path.abspath(cache_path)))
+    os.close(fd)
+    try:
+        cache.to_parquet(tmp_path)
+        os.replace(tmp_path, cache_path)
+    except (OSError, pa.ArrowException) as e:
+        print(f"Could not save cache {cache_path}: {e}")
+        os.remove(tmp_path)
+
+impedance_data['Rectified_Impedance'] = np.asarray(rectified_values, dtype=np.float32)
 
 # ----------------------------------------
 # Filtering Data
 # Remove entries with NaNs and outliers
-impedance_data_clean = impedance_data.dropna(subset=['Re','Rct','Rectified_Impedance'])
-
-# Apply filtering thresholds based on realistic ranges
-impedance_data_clean = impedance_data_clean[
-    (impedance_data_clean['Re'] > 0) & (impedance_data_clean['Re'] < 1) &
-    (impedance_data_clean['Rct'] > 0) & (impedance_data_clean['Rct'] < 1) &
-    (impedance_data_clean['Rectified_Impedance'] > 0) & (impedance_data_clean['Rectified_Impedance'] < 1)
-]
+# Apply filtering thresholds based on realistic ranges; NaNs fail every comparison, so they are
+# dropped as well. query() evaluates the whole expression in one pass with numexpr when it's installed
+impedance_data_clean = impedance_data.query(
+    '0 < Re < 1 and 0 < Rct < 1 and 0 < Rectified_Impedance < 1'
+)
 
 print("\nOriginal impedance_data length:", len(impedance_data))
 print("Filtered impedance_data length:", len(impedance_data_clean))
@@ -145,33 +257,30 @@ if len(impedance_data) == 0:
 # ----------------------------------------
 import plotly.express as px
 
-# Get list of battery_ids in the data
-battery_ids = impedance_data['battery_id'].unique()
-
 # Plot Re and Rct together with dual y-axes
 fig_combined = go.Figure()
 
-# Loop over each battery to add traces for Re and Rct
-for b_id in battery_ids:
-    battery_data = impedance_data[impedance_data['battery_id'] == b_id]
-    
+# Build the Re and Rct traces for each battery, then add them in one call
+traces = []
+for b_id, battery_data in impedance_data.groupby('battery_id', sort=False, observed=True):
     # Re trace
-    fig_combined.add_trace(go.Scatter(
+    traces.append(go.Scattergl(
         x=battery_data['impedance_cycle_number'],
         y=battery_data['Re'],
         mode='lines+markers',
         name=f'Re ({b_id})',
         yaxis='y1'
     ))
-    
+
     # Rct trace
-    fig_combined.add_trace(go.Scatter(
+    traces.append(go.Scattergl(
         x=battery_data['impedance_cycle_number'],
         y=battery_data['Rct'],
         mode='lines+markers',
         name=f'Rct ({b_id})',
         yaxis='y2'
     ))
+fig_combined.add_traces(traces)
 
 # Update layout with dual y-axes
 fig_combined.update_layout(
@@ -205,9 +314,8 @@ fig_combined.show()
 
 # Plot Rectified Impedance for each battery
 fig_rect = go.Figure()
-for b_id in battery_ids:
-    battery_data = impedance_data[impedance_data['battery_id'] == b_id]
-    fig_rect.add_trace(go.Scatter(
+for b_id, battery_data in impedance_data.groupby('battery_id', sort=False, observed=True):
+    fig_rect.add_trace(go.Scattergl(
         x=battery_data['impedance_cycle_number'],
         y=battery_data['Rectified_Impedance'],
         mode='lines+markers',
@@ -234,12 +342,9 @@ fig_rect.update_layout(
 fig_rect.show()
 
 # Plot Capacity over cycles for each battery
-battery_ids_discharge = discharge_data['battery_id'].unique()
-
 fig2 = go.Figure()
-for b_id in battery_ids_discharge:
-    battery_data = discharge_data[discharge_data['battery_id'] == b_id]
-    fig2.add_trace(go.Scatter(
+for b_id, battery_data in discharge_data.groupby('battery_id', sort=False, observed=True):
+    fig2.add_trace(go.Scattergl(
         x=battery_data['cycle_number'],
         y=battery_data['Capacity'],
         mode='lines+markers',